@@ -2,25 +2,73 @@ import argparse
 import asyncio
 from datetime import datetime, timedelta
 from itertools import chain
-from functools import partial
+from functools import lru_cache, partial
 import os
 import sys
+import time
 from typing import Optional
+from zoneinfo import ZoneInfo
 
-import aioredis
 import httpx
-import pytz
+import ijson
+import orjson
+from redis import asyncio as aioredis
 import yarl
 
 NYSE_LINK = "https://www.nyse.com/api/ipo-center/calendar"
 NASDAQ_LINK = yarl.URL("https://api.nasdaq.com/api/ipo/calendar")
-LAST_SENT_KEY = "email_last_sent"
+# Expires when the next email is due, so while it exists no email should be sent.
+# Renamed from email_last_sent, which was written without an expiry.
+LAST_SENT_KEY = "email_last_sent_at"
+NYSE_CACHE_KEY = "ipo:nyse:calendar"
+NASDAQ_CACHE_KEY = "ipo:nasdaq:{month}"
+# Calendars change at most daily; stale copies are kept around as a fallback for when an API is down
+CALENDAR_CACHE_TTL = 60 * 60
+CALENDAR_STALE_TTL = 24 * 60 * 60
 # Nasdaq requests require a user agent that looks like a browser
 CHROME_UA = "Mozilla/5.0 (Windows NT 6.1; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/88.0.4324.104 Safari/537.36"
-PACIFC_TIMEZONE = pytz.timezone("US/Pacific")
+NASDAQ_HEADERS = {"user-agent": CHROME_UA}
+PACIFIC_TIMEZONE = ZoneInfo("America/Los_Angeles")
+UTC = ZoneInfo("UTC")
 SATURDAY = 6
 SUNDAY = 7
 
+# Shared across every request made by the process so connections get reused
+_CLIENT: Optional[httpx.AsyncClient] = None
+_REDIS_POOL: Optional[aioredis.ConnectionPool] = None
+
+
+def get_client() -> httpx.AsyncClient:
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(5.0, connect=2.0),
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+        )
+    return _CLIENT
+
+
+async def close_client():
+    global _CLIENT
+    if _CLIENT is not None:
+        await _CLIENT.aclose()
+        _CLIENT = None
+
+
+def get_redis(redis_url) -> aioredis.Redis:
+    global _REDIS_POOL
+    if _REDIS_POOL is None:
+        _REDIS_POOL = aioredis.ConnectionPool.from_url(redis_url, max_connections=10, decode_responses=True)
+    return aioredis.Redis(connection_pool=_REDIS_POOL)
+
+
+async def close_redis():
+    global _REDIS_POOL
+    if _REDIS_POOL is not None:
+        await _REDIS_POOL.disconnect()
+        _REDIS_POOL = None
+
 
 def make_company_line(name, symbol) -> str:
     return f"Company: {name} ({symbol})" if symbol else f"Company: {name}"
@@ -30,14 +78,29 @@ def parse_date(date_str) -> Optional[datetime]:
     if not date_str:
         return None
     try:
-        datetime.strptime(date_str, "%m/%d/%Y")
+        # Dates are always MM/DD/YYYY, splitting avoids strptime's per-call format parsing
+        month, day, year = date_str.split("/")
+        return datetime(int(year), int(month), int(day))
     except ValueError as e:
         print(str(e))
         return None
 
 
-def filter_company(company, dow=None):
-    return company.expected_date is not None and company.expected_date.isoweekday() == dow
+# Drops a float's trailing .0 without hiding a real fractional part
+def whole_number(value):
+    ival = int(value)
+    return ival if ival == value else value
+
+
+# Parses each row's date once and only builds company objects for rows expected on dow (all rows when None)
+def build_companies(cls, rows, date_field, dow=None):
+    companies = []
+    for row in rows:
+        expected_date = parse_date(row[date_field])
+        if dow is None or (expected_date is not None and expected_date.isoweekday() == dow):
+            companies.append(cls(row, expected_date))
+    return companies
+
 
 """
     {
@@ -64,33 +127,32 @@ def filter_company(company, dow=None):
     }
 """
 class NYSE:
-    def __init__(self, payload):
+    __slots__ = ("name", "symbol", "amount_filed", "shares_filed", "price_range", "expected_date")
+
+    def __init__(self, payload, expected_date):
         self.name = payload["issuer_nm"]
         self.symbol = payload["symbol"]
-        amount_filed = payload["current_filed_proceeds_with_overallotment_usd_amt"]
-        self.amount_filed = int(amount_filed) if int(amount_filed) == amount_filed else amount_filed
-        shares_filed = payload["current_shares_filed"]
-        self.shares_filed = int(shares_filed) if int(shares_filed) == shares_filed else shares_filed
+        self.amount_filed = whole_number(payload["current_filed_proceeds_with_overallotment_usd_amt"])
+        self.shares_filed = whole_number(payload["current_shares_filed"])
         self.price_range = payload["current_file_price_range_usd"]
-        self.expected_date = parse_date(payload["expected_dt_report"])
+        self.expected_date = expected_date
 
     def __str__(self):
-        return "\n".join(
-            [
-                make_company_line(self.name, self.symbol),
-                f"Offering: {self.shares_filed} / {self.amount_filed}",
-                f"Price: {self.price_range}"
-            ]
-        )
+        return f"{make_company_line(self.name, self.symbol)}\nOffering: {self.shares_filed} / {self.amount_filed}\nPrice: {self.price_range}"
 
 
-async def get_nyse(session):
+async def fetch_nyse_rows(session):
     resp = await session.get(NYSE_LINK)
     if resp.status_code != 200:
-        print(f"non 200  status {resp.status_code}: {resp.json()}")
-        return []
-    payload = resp.json()
-    return [NYSE(c) for c in payload["calendarList"]]
+        print(f"non 200  status {resp.status_code}: {resp.text}")
+        return None
+    payload = orjson.loads(resp.content)
+    return payload.get("calendarList")
+
+
+async def get_nyse(session, redis, dow=None):
+    rows = await cached_fetch(redis, NYSE_CACHE_KEY, CALENDAR_CACHE_TTL, partial(fetch_nyse_rows, session))
+    return build_companies(NYSE, rows, "expected_dt_report", dow)
 
 
 """
@@ -106,72 +168,120 @@ async def get_nyse(session):
 }
 """
 class Nasdaq:
-    def __init__(self, payload):
-        print(payload)
+    __slots__ = ("name", "symbol", "amount_filed", "price_range", "expected_date")
+
+    def __init__(self, payload, expected_date):
         self.name = payload["companyName"]
         self.symbol = payload["proposedTickerSymbol"]
         amount_filed = payload["sharesOffered"].replace(",", "")
         if amount_filed:
-            self.amount_filed = int(amount_filed) if int(amount_filed) == amount_filed else amount_filed
+            self.amount_filed = int(amount_filed)
         else:
             self.amount_filed = "Unspecified"
         self.price_range = payload["proposedSharePrice"]
-        self.expected_date = parse_date(payload["expectedPriceDate"])
+        self.expected_date = expected_date
 
     def __str__(self):
-        return "\n".join(
-            [
-                make_company_line(self.name, self.symbol),
-                f"Offering: {self.amount_filed}",
-                f"Price: {self.price_range}"
-            ]
-        )
+        return f"{make_company_line(self.name, self.symbol)}\nOffering: {self.amount_filed}\nPrice: {self.price_range}"
 
 
 def utcnow():
-    return datetime.utcnow().replace(tzinfo=pytz.UTC)
+    return datetime.now(UTC)
 
 
-def pacnow():
-    return utcnow().astimezone(PACIFC_TIMEZONE)
+async def is_sendable_time(redis, current_time_pac) -> bool:
+    if current_time_pac.isoweekday() == SATURDAY:
+        return False
+    return not (redis and await redis.exists(LAST_SENT_KEY))
+
+
+def seconds_until_next_send(current_time_pac) -> int:
+    # Next send is due at 8 the following day or a day from now, whichever comes first
+    next_window = (current_time_pac + timedelta(days=1)).replace(hour=8, minute=0, second=0, microsecond=0)
+    until_next_window = next_window.astimezone(UTC) - current_time_pac.astimezone(UTC)
+    return int(min(until_next_window, timedelta(days=1)).total_seconds())
+
+
+@lru_cache(maxsize=2)
+def nasdaq_url_for(month_qp) -> str:
+    return str(NASDAQ_LINK.with_query({"date": month_qp}))
+
+
+async def fetch_nasdaq_rows(session, month_qp):
+    async with session.stream("GET", nasdaq_url_for(month_qp), headers=NASDAQ_HEADERS) as resp:
+        if resp.status_code != 200:
+            await resp.aread()
+            print(f"non 200  status {resp.status_code}: {resp.text}")
+            return None
+        # Only the upcoming rows are used, so pull them out of the stream instead of parsing the whole calendar
+        found = ijson.sendable_list()
+        parser = ijson.items_coro(found, "data.upcoming.upcomingTable.rows", use_float=True)
+        async for chunk in resp.aiter_bytes():
+            # httpx ends the stream with an empty chunk, which ijson would take as end of input
+            if chunk:
+                parser.send(chunk)
+        parser.close()
+        # No rows array means an error payload (e.g. "data": null), not an empty calendar
+        if not found or not isinstance(found[0], list):
+            print(f"no upcoming rows in Nasdaq response for {month_qp}")
+            return None
+        return found[0]
+
+
+async def get_nasdaq(session, redis, now_utc, dow=None):
+    # TODO: Resolve what happens when a week spans 2 months
+    month_qp = now_utc.strftime("%Y-%m")
+    key = NASDAQ_CACHE_KEY.format(month=month_qp)
+    rows = await cached_fetch(redis, key, CALENDAR_CACHE_TTL, partial(fetch_nasdaq_rows, session, month_qp))
+    return build_companies(Nasdaq, rows, "expectedPriceDate", dow)
 
 
-async def is_sendable_time(redis) -> bool:
-    last_sent = await get_last_sent(redis)
-    if not last_sent:
-        return True
+# Serve rows cached under key if younger than ttl seconds, otherwise fetch and cache them.
+# A failed fetch falls back to the stale cached rows, if any.
+async def cached_fetch(redis, key, ttl, fetch):
+    cached = orjson.loads(await redis.get(key) or "null") if redis else None
+    if cached and time.time() - cached["fetched_at"] < ttl:
+        return cached["body"]
 
-    last_send_time = datetime.fromisoformat(last_sent).replace(tzinfo=pytz.UTC)
-    current_time_pac = pacnow()
-    if current_time_pac.isoweekday() == SATURDAY:
-        return False
+    try:
+        rows = await fetch()
+    except (httpx.HTTPError, orjson.JSONDecodeError, ijson.JSONError) as e:
+        print(f"fetch for {key} failed: {e}")
+        rows = None
+    if rows is None:
+        return cached["body"] if cached else []
 
-    # (b/w 8 and 10 when last send was a different day) or (no email for over a day)
-    return (8 <= current_time_pac.hour <= 10 and last_send_time.day != current_time_pac.day) or current_time_pac - last_send_time >= timedelta(days=1)
+    if redis:
+        await redis.set(key, orjson.dumps({"fetched_at": time.time(), "body": rows}), ex=CALENDAR_STALE_TTL)
+    return rows
 
 
-async def get_nasdaq(session):
-    # TODO: Resolve what happens when a week spans 2 months
-    month_qp = datetime.utcnow().strftime("%Y-%m")
-    req = NASDAQ_LINK.with_query({"date": month_qp})
-    resp = await session.get(str(req), headers={"user-agent": CHROME_UA})
-    if resp.status_code != 200:
-        print(f"non 200  status {resp.status_code}: {resp.json()}")
-        return []
-    payload = resp.json()
-    return [Nasdaq(c) for c in payload["data"]["upcoming"]["upcomingTable"]["rows"]]
+async def no_companies():
+    return []
 
 
-async def get_last_sent(redis) -> Optional[datetime]:
+# Atomically claims this run's send, returns False when another run already claimed it
+async def set_last_sent(redis, now_utc, now_pac) -> bool:
     if not redis:
-        return None
-    return await redis.get(LAST_SENT_KEY, encoding="utf-8")
+        return True
+    claimed = await redis.set(
+        LAST_SENT_KEY, int(now_utc.timestamp()), ex=seconds_until_next_send(now_pac), nx=True
+    )
+    return bool(claimed)
 
 
-async def set_last_sent(redis):
+async def clear_last_sent(redis):
     if not redis:
         return
-    await redis.set(LAST_SENT_KEY, datetime.utcnow().isoformat())
+    await redis.delete(LAST_SENT_KEY)
+
+
+async def run(base_url, api_key, from_addr, to_addrs, ignore_redis):
+    try:
+        await main(base_url, api_key, from_addr, to_addrs, ignore_redis)
+    finally:
+        await close_client()
+        await close_redis()
 
 
 async def main(base_url, api_key, from_addr, to_addrs, ignore_redis):
@@ -180,34 +290,54 @@ async def main(base_url, api_key, from_addr, to_addrs, ignore_redis):
         print(f"No redis server URL set / ignore redis is {ignore_redis}")
         redis = None
     else:
-        redis = await aioredis.create_redis_pool(redis_url)
-
-    if not await is_sendable_time(redis):
+        redis = get_redis(redis_url)
+
+    # Read the clock once so every check in this run agrees on the time
+    now_utc = utcnow()
+    now_pac = now_utc.astimezone(PACIFIC_TIMEZONE)
+    # Gate before anything touches the network: runs that will not send only make a Redis EXISTS call
+    # and never create the HTTP client
+    if not await is_sendable_time(redis, now_pac):
         print("Not a sendable time")
         return
+    if not await set_last_sent(redis, now_utc, now_pac):
+        print("Email already sent by another worker")
+        return
+
+    try:
+        await send_email(base_url, api_key, from_addr, to_addrs, redis, now_utc, now_pac)
+    except BaseException:
+        # Give the send slot back so the next run can retry, without masking the original failure
+        try:
+            await clear_last_sent(redis)
+        except Exception as e:
+            print(f"Could not clear {LAST_SENT_KEY}: {e}")
+        raise
+
 
+async def send_email(base_url, api_key, from_addr, to_addrs, redis, now_utc, now_pac):
     base_url = yarl.URL(base_url) / "messages"
-    dow = pacnow().isoweekday()
+    dow = now_pac.isoweekday()
     daystr = "This week" if dow == SUNDAY else "Today"
     payload = {
         "from": from_addr,
         "to": to_addrs,
         "subject": f"{daystr}'s IPOs"
     }
-    async with httpx.AsyncClient(timeout=5.0) as session:
-        nyse = await get_nyse(session)
-        nasdaq = await get_nasdaq(session) if os.environ.get("ENABLE_NASDAQ_EMAIL") else []
-        filtered_companies = chain(nyse, nasdaq)
-        if dow != SUNDAY:
-            filtered_companies = filter(partial(filter_company, dow=dow), filtered_companies)
-        email_text = "\n\n".join([str(c) for c in filtered_companies])
-        if not email_text:
-            email_text = "There are no IPOs scheduled for today"
-        payload["text"] = email_text
-        resp = await session.post(str(base_url), auth=("api", api_key), data=payload)
-        resp.raise_for_status()
-        print(resp.json())
-    await set_last_sent(redis)
+    # Sunday's email covers the whole week
+    company_dow = None if dow == SUNDAY else dow
+    session = get_client()
+    nyse, nasdaq = await asyncio.gather(
+        get_nyse(session, redis, company_dow),
+        get_nasdaq(session, redis, now_utc, company_dow) if os.environ.get("ENABLE_NASDAQ_EMAIL") else no_companies()
+    )
+    email_text = "\n\n".join(str(c) for c in chain(nyse, nasdaq))
+    if not email_text:
+        email_text = "There are no IPOs scheduled for today"
+    payload["text"] = email_text
+    resp = await session.post(str(base_url), auth=("api", api_key), data=payload)
+    resp.raise_for_status()
+    print(resp.json())
 
 
 def parse_cli_args():
@@ -223,4 +353,4 @@ def parse_cli_args():
 if __name__ == "__main__":
     args = parse_cli_args()
 
-    asyncio.run(main(args.base_api_url, args.api_key, args.from_addr, args.to_addrs, args.ignore_redis))
+    asyncio.run(run(args.base_api_url, args.api_key, args.from_addr, args.to_addrs, args.ignore_redis))